@@ -53,6 +53,16 @@ class MissingInputError(Exception):
     pass
 
 
+class NotInFunctionGraphError(Exception):
+    """
+    A Variable or Apply node given to a FunctionGraph method belongs to
+    another FunctionGraph.
+
+    """
+
+    pass
+
+
 class FunctionGraph(utils.object2):
     """
     WRITEME
@@ -141,6 +151,9 @@ class FunctionGraph(utils.object2):
         # XXX: Unless I'm missing something (but there's no documentation,
         # so I probably am) this should be a set.
         self._features = []
+        # Cache of execute_callbacks: name -> list of (feature, callback).
+        # Emptied each time a feature is attached or removed.
+        self._callbacks = {}
 
         # All apply nodes in the subgraph defined by inputs and
         # outputs are cached in this field
@@ -512,8 +525,9 @@ class FunctionGraph(utils.object2):
             self.outputs[i] = new_r
         else:
             if node.fgraph is not self:
-                raise Exception("Cannot operate on %s because it does not"
-                                " belong to this FunctionGraph" % node)
+                raise NotInFunctionGraphError(
+                    "Cannot operate on %s because it does not"
+                    " belong to this FunctionGraph" % node)
             r = node.inputs[i]
             if not r.type == new_r.type:
                 raise TypeError("The type of the replacement must be the"
@@ -549,8 +563,9 @@ class FunctionGraph(utils.object2):
         if verbose:
             print(reason, r, new_r)
         if hasattr(r, 'fgraph') and r.fgraph is not self:
-            raise Exception("Cannot replace %s because it does not belong "
-                            "to this FunctionGraph" % r, str(reason))
+            raise NotInFunctionGraphError(
+                "Cannot replace %s because it does not belong "
+                "to this FunctionGraph" % r, str(reason))
         if r.type != new_r.type:
             new_r2 = r.type.convert_variable(new_r)
             # We still make sure that the type converts correctly
@@ -630,6 +645,7 @@ class FunctionGraph(utils.object2):
 
         # Add the feature
         self._features.append(feature)
+        self._callbacks.clear()
 
     def remove_feature(self, feature):
         """
@@ -646,6 +662,7 @@ class FunctionGraph(utils.object2):
             self._features.remove(feature)
         except ValueError:
             return
+        self._callbacks.clear()
         detach = getattr(feature, 'on_detach', None)
         if detach is not None:
             detach(self)
@@ -661,14 +678,19 @@ class FunctionGraph(utils.object2):
 
         """
         t0 = time.time()
-        for feature in self._features:
-            try:
-                fn = getattr(feature, name)
-            except AttributeError:
-                # this is safe because there is no work done inside the
-                # try; the AttributeError reall must come from feature.${name}
-                # not existing
-                continue
+        # This is called for every change of the graph. Looking up the
+        # callbacks once per name avoids a getattr on each feature, and an
+        # AttributeError for each feature that doesn't define it.
+        try:
+            callbacks = self._callbacks[name]
+        except KeyError:
+            callbacks = []
+            for feature in self._features:
+                fn = getattr(feature, name, None)
+                if fn is not None:
+                    callbacks.append((feature, fn))
+            self._callbacks[name] = callbacks
+        for feature, fn in callbacks:
             tf0 = time.time()
             fn(self, *args, **kwargs)
             self.execute_callbacks_times[feature] += time.time() - tf0
@@ -870,11 +892,15 @@ class FunctionGraph(utils.object2):
         # be pickled as the decorators with parameters aren't pickable.
         if "execute_callbacks_times" in d:
             del d["execute_callbacks_times"]
+        # The cached callbacks are bound methods.
+        if "_callbacks" in d:
+            del d["_callbacks"]
 
         return d
 
     def __setstate__(self, dct):
         self.__dict__.update(dct)
+        self._callbacks = {}
         for feature in self._features:
             if hasattr(feature, "unpickle"):
                 feature.unpickle(self)
@@ -5,10 +5,12 @@ import sys
 import unittest
 
 from nose.plugins.skip import SkipTest
+from six.moves import StringIO
 
 import theano
 from theano.compat import PY3
-from theano.gof import CachedConstantError, FunctionGraph
+from theano.gof import (CachedConstantError, FunctionGraph,
+                        NotInFunctionGraphError)
 from theano import tensor as tt
 
 
@@ -24,6 +26,57 @@ class TFunctionGraph(unittest.TestCase):
         assert v.cached
         FunctionGraph([], [v + 1])
 
+    def test_not_in_function_graph(self):
+        x, y = tt.vectors('xy')
+        fg = FunctionGraph([x, y], [x + y])
+        out = FunctionGraph([x, y], [x * y]).outputs[0]
+        self.assertRaises(NotInFunctionGraphError,
+                          fg.replace, out, fg.inputs[0])
+        self.assertRaises(NotInFunctionGraphError,
+                          fg.change_input, out.owner, 0, fg.inputs[0])
+
+        # This is an expected failure for replace_all_validate: it must
+        # not be reported as a bug.
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(NotInFunctionGraphError,
+                              fg.replace_all_validate, [(out, fg.inputs[0])])
+            err = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        assert 'BUG IN FGRAPH.REPLACE' not in err, err
+        assert all(a is b for a, b in zip(fg.outputs[0].owner.inputs,
+                                          fg.inputs))
+
+    def test_callbacks_cache(self):
+        class CountChanges(theano.gof.toolbox.Feature):
+            def __init__(self):
+                self.nb = 0
+
+            def on_change_input(self, fgraph, node, i, r, new_r,
+                                reason=None):
+                self.nb += 1
+
+        x = tt.vector()
+        func = FunctionGraph([x], [tt.exp(tt.exp(x))])
+        x = func.inputs[0]
+
+        def replace_inner(new_r):
+            func.replace(func.outputs[0].owner.inputs[0], new_r)
+
+        replace_inner(tt.sin(x))
+        assert 'on_change_input' in func._callbacks
+
+        counter = CountChanges()
+        func.attach_feature(counter)
+        replace_inner(tt.cos(x))
+        assert counter.nb == 1
+
+        func.remove_feature(counter)
+        replace_inner(tt.tan(x))
+        assert counter.nb == 1
+
     def test_pickle(self):
         v = tt.vector()
         func = theano.gof.FunctionGraph([v], [v + 1])
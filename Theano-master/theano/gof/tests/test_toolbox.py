@@ -1,11 +1,15 @@
 
 
-from theano.gof.graph import Variable, Apply
+import gc
+import weakref
+
+from theano.gof.graph import Variable, Apply, io_toposort
 from theano.gof.type import Type
 from theano.gof.op import Op
 
 from theano.gof.fg import FunctionGraph
 from theano.gof.toolbox import *  # noqa
+from theano.gof.toolbox import _fast_toposort
 
 
 def as_variable(x):
@@ -86,3 +90,30 @@ class TestNodeFinder:
         for type, num in ((add, 4), (sigmoid, 3), (dot, 1)):
             if not len([t for t in g.get_nodes(type)]) == num:
                 raise Exception("Expected: %i times %s" % (num, type))
+
+
+def test_fast_toposort():
+    x, y, z = inputs()
+    e0 = dot(y, z)
+    e = add(add(sigmoid(x), sigmoid(sigmoid(z))), dot(add(x, y), e0))
+    order = _fast_toposort([x, y, z], [e, e0])
+    assert set(order) == set(io_toposort([x, y, z], [e, e0]))
+    for i, node in enumerate(order):
+        for inp in node.inputs:
+            if inp.owner is not None:
+                assert inp.owner in order[:i]
+    assert order == _fast_toposort([x, y, z], [e, e0])
+
+
+def test_history_does_not_keep_fgraph_alive():
+    # If on_detach is never called, History must not keep the fgraph alive.
+    x, y, z = inputs()
+    g = FunctionGraph([x, y, z], [add(x, y)])
+    chk = g.checkpoint()
+    g.replace(g.outputs[0], g.outputs[0].owner.inputs[0])
+    g.revert(chk)
+    assert g._history_list == []
+    ref = weakref.ref(g)
+    del g
+    gc.collect()
+    assert ref() is None
@@ -1,13 +1,13 @@
 
+from collections import defaultdict, deque
 from functools import partial
+from itertools import islice
 import sys
 import time
-import inspect
 
 import theano
 from theano import config
 from theano.compat import OrderedDict
-from theano.gof import graph
 
 
 class AlreadyThere(Exception):
@@ -111,44 +111,72 @@ class Feature(object):
         return OrderedDict()
 
 
+def _fast_toposort(inputs, outputs):
+    """
+    Return the Apply nodes between inputs and outputs in topological order.
+
+    This is equivalent to graph.io_toposort without orderings, but it
+    uses an iterative Kahn's algorithm. The order is deterministic.
+
+    """
+    iset = set(inputs)
+    # Number of dependencies on other Apply nodes that are not yet sorted.
+    in_degree = {}
+    clients = {}
+    seen = []
+    stack = [o.owner for o in reversed(outputs)
+             if o.owner is not None and o not in iset]
+    while stack:
+        node = stack.pop()
+        if node in in_degree:
+            continue
+        in_degree[node] = 0
+        seen.append(node)
+        for inp in node.inputs:
+            parent = inp.owner
+            if parent is None or inp in iset:
+                continue
+            in_degree[node] += 1
+            clients.setdefault(parent, []).append(node)
+            if parent not in in_degree:
+                stack.append(parent)
+
+    queue = deque(node for node in seen if in_degree[node] == 0)
+    order = []
+    while queue:
+        node = queue.popleft()
+        order.append(node)
+        for client in clients.get(node, ()):
+            in_degree[client] -= 1
+            if in_degree[client] == 0:
+                queue.append(client)
+    return order
+
+
 class Bookkeeper(Feature):
 
     def on_attach(self, fgraph):
-        for node in graph.io_toposort(fgraph.inputs, fgraph.outputs):
+        for node in _fast_toposort(fgraph.inputs, fgraph.outputs):
             self.on_import(fgraph, node, "on_attach")
 
     def on_detach(self, fgraph):
-        for node in graph.io_toposort(fgraph.inputs, fgraph.outputs):
+        for node in _fast_toposort(fgraph.inputs, fgraph.outputs):
             self.on_prune(fgraph, node, 'Bookkeeper.detach')
 
 
-class GetCheckpoint:
+class GetCheckpoint(object):
+    __slots__ = ('fgraph', 'nb')
 
-    def __init__(self, history, fgraph):
-        self.h = history
+    def __init__(self, fgraph):
         self.fgraph = fgraph
         self.nb = 0
 
     def __call__(self):
-        self.h.history[self.fgraph] = []
+        self.fgraph._history_list = []
         self.nb += 1
         return self.nb
 
 
-class LambdExtract:
-
-    def __init__(self, fgraph, node, i, r, reason=None):
-        self.fgraph = fgraph
-        self.node = node
-        self.i = i
-        self.r = r
-        self.reason = reason
-
-    def __call__(self):
-        return self.fgraph.change_input(self.node, self.i, self.r,
-                                        reason=("Revert", self.reason))
-
-
 class History(Feature):
     """Keep an history of changes to an FunctionGraph.
 
@@ -156,37 +184,40 @@ class History(Feature):
     revert to only 1 point in the past. This limit was added to lower
     the memory usage.
 
-    """
-    pickle_rm_attr = ["checkpoint", "revert"]
+    The changes are kept in fgraph._history_list, so recording one
+    doesn't need a lookup keyed on the fgraph.
 
-    def __init__(self):
-        self.history = {}
+    """
+    pickle_rm_attr = ["checkpoint", "revert", "_history_list"]
 
-    def on_attach(self, fgraph):
+    def check_attach(self, fgraph):
         if hasattr(fgraph, 'checkpoint') or hasattr(fgraph, 'revert'):
             raise AlreadyThere("History feature is already present or in"
                                " conflict with another plugin.")
-        self.history[fgraph] = []
-        # Don't call unpickle here, as ReplaceValidate.on_attach()
-        # call to History.on_attach() will call the
-        # ReplaceValidate.unpickle and not History.unpickle
-        fgraph.checkpoint = GetCheckpoint(self, fgraph)
-        fgraph.revert = partial(self.revert, fgraph)
+
+    def on_attach(self, fgraph):
+        History.check_attach(self, fgraph)
+        # Don't call self.unpickle here, as for a ReplaceValidate it
+        # is ReplaceValidate.unpickle and not History.unpickle.
+        History.unpickle(self, fgraph)
 
     def unpickle(self, fgraph):
-        fgraph.checkpoint = GetCheckpoint(self, fgraph)
+        fgraph._history_list = []
+        fgraph.checkpoint = GetCheckpoint(fgraph)
         fgraph.revert = partial(self.revert, fgraph)
 
     def on_detach(self, fgraph):
         del fgraph.checkpoint
         del fgraph.revert
-        del self.history[fgraph]
+        del fgraph._history_list
 
     def on_change_input(self, fgraph, node, i, r, new_r, reason=None):
-        if self.history[fgraph] is None:
+        h = fgraph._history_list
+        if h is None:  # The fgraph is being reverted.
             return
-        h = self.history[fgraph]
-        h.append(LambdExtract(fgraph, node, i, r, reason))
+        # Only what is needed to undo the change is kept: a plain tuple
+        # is much lighter than an object per change.
+        h.append((node, i, r, reason))
 
     def revert(self, fgraph, checkpoint):
         """
@@ -195,28 +226,32 @@ class History(Feature):
         given time can be obtained using self.checkpoint().
 
         """
-        h = self.history[fgraph]
-        self.history[fgraph] = None
-        assert fgraph.checkpoint.nb == checkpoint
-        while h:
-            f = h.pop()
-            f()
-        self.history[fgraph] = h
+        h = fgraph._history_list
+        # Changes made while reverting must not be recorded.
+        fgraph._history_list = None
+        try:
+            assert fgraph.checkpoint.nb == checkpoint
+            change_input = fgraph.change_input
+            for node, i, r, reason in reversed(h):
+                change_input(node, i, r, reason=("Revert", reason))
+        finally:
+            fgraph._history_list = []
 
 
 class Validator(Feature):
     pickle_rm_attr = ["validate", "consistent"]
 
-    def on_attach(self, fgraph):
+    def check_attach(self, fgraph):
         for attr in ('validate', 'validate_time'):
             if hasattr(fgraph, attr):
                 raise AlreadyThere("Validator feature is already present or in"
                                    " conflict with another plugin.")
-        # Don't call unpickle here, as ReplaceValidate.on_attach()
-        # call to History.on_attach() will call the
-        # ReplaceValidate.unpickle and not History.unpickle
-        fgraph.validate = partial(self.validate_, fgraph)
-        fgraph.consistent = partial(self.consistent_, fgraph)
+
+    def on_attach(self, fgraph):
+        Validator.check_attach(self, fgraph)
+        # Don't call self.unpickle here, as for a ReplaceValidate it
+        # is ReplaceValidate.unpickle and not Validator.unpickle.
+        Validator.unpickle(self, fgraph)
 
     def unpickle(self, fgraph):
         fgraph.validate = partial(self.validate_, fgraph)
@@ -226,32 +261,39 @@ class Validator(Feature):
         del fgraph.validate
         del fgraph.consistent
 
-    def validate_(self, fgraph):
-        t0 = time.time()
+    def validate_(self, fgraph, caller=None, verbose=False, r=None):
+        """
+        Run the 'validate' callbacks of all the features of fgraph.
+
+        Parameters
+        ----------
+        caller : str, optional
+            Name of the calling function. When it is 'replace_all_validate',
+            the exception is raised without printing anything as the caller
+            prints its own verbose output.
+        verbose : bool
+            If True, print why the validation failed.
+        r
+            Variable that was being replaced, only used in the verbose
+            output.
+
+        """
+        profile = fgraph.profile
+        if profile:
+            t0 = time.time()
         try:
             ret = fgraph.execute_callbacks('validate')
         except Exception as e:
-            cf = inspect.currentframe()
-            uf = cf.f_back
-            uf_info = inspect.getframeinfo(uf)
-
             # If the caller is replace_all_validate, just raise the
             # exception. replace_all_validate will print out the
             # verbose output.
             # Or it has to be done here before raise.
-            if uf_info.function == 'replace_all_validate':
-                raise
-            else:
-                verbose = uf.f_locals.get('verbose', False)
-                if verbose:
-                    r = uf.f_locals.get('r', "")
-                    reason = uf_info.function
-                    print("validate failed on node %s.\n Reason: %s, %s" %
-                          (r, reason, e))
-                raise
-        t1 = time.time()
-        if fgraph.profile:
-            fgraph.profile.validate_time += t1 - t0
+            if caller != 'replace_all_validate' and verbose:
+                print("validate failed on node %s.\n Reason: %s, %s" %
+                      (r, caller, e))
+            raise
+        if profile:
+            profile.validate_time += time.time() - t0
         return ret
 
     def consistent_(self, fgraph):
@@ -273,15 +315,18 @@ class ReplaceValidate(History, Validator):
             if hasattr(fgraph, attr):
                 raise AlreadyThere("ReplaceValidate feature is already present"
                                    " or in conflict with another plugin.")
+        History.check_attach(self, fgraph)
+        Validator.check_attach(self, fgraph)
         self._nodes_removed = set()
         self.fail_validate = False
-        History.on_attach(self, fgraph)
-        Validator.on_attach(self, fgraph)
+        # This also binds the History and Validator methods.
         self.unpickle(fgraph)
 
     def unpickle(self, fgraph):
         History.unpickle(self, fgraph)
         Validator.unpickle(self, fgraph)
+        # Reading the config is slow, don't do it for every replacement.
+        self._verbose_default = config.optimizer_verbose
         fgraph.replace_validate = partial(self.replace_validate, fgraph)
         fgraph.replace_all_validate = partial(self.replace_all_validate,
                                               fgraph)
@@ -303,16 +348,28 @@ class ReplaceValidate(History, Validator):
                              reason=None, verbose=None):
         chk = fgraph.checkpoint()
         if verbose is None:
-            verbose = config.optimizer_verbose
+            verbose = self._verbose_default
+        # Replacing a variable by itself or doing the same replacement
+        # twice is a no-op, but would still go through all the callbacks.
+        seen = set()
         for r, new_r in replacements:
+            if r is new_r:
+                continue
+            key = (id(r), id(new_r))
+            if key in seen:
+                continue
+            seen.add(key)
             try:
                 fgraph.replace(r, new_r, reason=reason, verbose=False)
+            except (TypeError, theano.gof.NotInFunctionGraphError):
+                # Expected failures: the replacement doesn't have a
+                # compatible type or r doesn't belong to this FunctionGraph.
+                fgraph.revert(chk)
+                raise
             except Exception as e:
-                msg = str(e)
-                s1 = 'The type of the replacement must be the same'
-                s2 = 'does not belong to this FunctionGraph'
-                s3 = 'maximum recursion depth exceeded'
-                if s3 in msg:
+                # RecursionError (Python >= 3.5) is a RuntimeError.
+                if (isinstance(e, RuntimeError) and
+                        'maximum recursion depth exceeded' in str(e)):
                     # There is nothing safe we can do to recover from this.
                     # So don't revert as this raise a different error
                     # that isn't helpful.
@@ -322,16 +379,15 @@ class ReplaceValidate(History, Validator):
                         " stack limit with:"
                         " import sys; sys.setrecursionlimit(10000)",)
                     raise
-                elif (s1 not in msg and s2 not in msg):
-                    out = sys.stderr
-                    print("<<!! BUG IN FGRAPH.REPLACE OR A LISTENER !!>>",
-                          type(e), e, reason, file=out)
+                out = sys.stderr
+                print("<<!! BUG IN FGRAPH.REPLACE OR A LISTENER !!>>",
+                      type(e), e, reason, file=out)
                 # this might fail if the error is in a listener:
                 # (fgraph.replace kinda needs better internal error handling)
                 fgraph.revert(chk)
                 raise
         try:
-            fgraph.validate()
+            fgraph.validate(caller='replace_all_validate')
         except Exception as e:
             fgraph.revert(chk)
             if verbose:
@@ -351,27 +407,22 @@ class ReplaceValidate(History, Validator):
         """
         chk = fgraph.replace_all_validate(replacements, reason)
         self._nodes_removed.update(remove)
-        for rm in remove:
-            if rm in fgraph.apply_nodes or rm in fgraph.variables:
-                fgraph.revert(chk)
-                if warn:
-                    out = sys.stderr
-                    print(
-                        "WARNING: An optimization wanted to replace a Variable"
-                        " in the graph, but the replacement for it doesn't"
-                        " remove it. We disabled the optimization."
-                        " Your function runs correctly, but it would be"
-                        " appreciated if you submit this problem to the"
-                        " mailing list theano-users so that we can fix it.",
-                        file=out)
-                    print(reason, replacements, file=out)
-                raise ReplacementDidntRemovedError()
-
-    def __getstate__(self):
-        d = self.__dict__.copy()
-        if "history" in d:
-            del d["history"]
-        return d
+        apply_nodes = fgraph.apply_nodes
+        variables = fgraph.variables
+        if any(rm in apply_nodes or rm in variables for rm in remove):
+            fgraph.revert(chk)
+            if warn:
+                out = sys.stderr
+                print(
+                    "WARNING: An optimization wanted to replace a Variable"
+                    " in the graph, but the replacement for it doesn't"
+                    " remove it. We disabled the optimization."
+                    " Your function runs correctly, but it would be"
+                    " appreciated if you submit this problem to the"
+                    " mailing list theano-users so that we can fix it.",
+                    file=out)
+                print(reason, replacements, file=out)
+            raise ReplacementDidntRemovedError()
 
     def on_import(self, fgraph, node, reason):
         if node in self._nodes_removed:
@@ -387,7 +438,7 @@ class NodeFinder(Bookkeeper):
 
     def __init__(self):
         self.fgraph = None
-        self.d = {}
+        self.d = defaultdict(list)
 
     def on_attach(self, fgraph):
         if self.fgraph is not None:
@@ -410,16 +461,9 @@ class NodeFinder(Bookkeeper):
 
     def on_import(self, fgraph, node, reason):
         try:
-            self.d.setdefault(node.op, []).append(node)
+            self.d[node.op].append(node)
         except TypeError:  # node.op is unhashable
             return
-        except Exception as e:
-            print('OFFENDING node', type(node), type(node.op), file=sys.stderr)
-            try:
-                print('OFFENDING node hash', hash(node.op), file=sys.stderr)
-            except Exception:
-                print('OFFENDING node not hashable', file=sys.stderr)
-            raise e
 
     def on_prune(self, fgraph, node, reason):
         try:
@@ -432,18 +476,28 @@ class NodeFinder(Bookkeeper):
 
     def query(self, fgraph, op):
         try:
-            all = self.d.get(op, [])
+            all = self.d.get(op)
         except TypeError:
             raise TypeError("%s in unhashable and cannot be queried by the"
                             " optimizer" % op)
-        all = list(all)
-        return all
+        return list(all) if all else []
+
+
+def _no_op(*args, **kwargs):
+    pass
 
 
 class PrintListener(Feature):
 
     def __init__(self, active=True):
         self.active = active
+        if not active:
+            # Don't pay for the callbacks when there is nothing to print.
+            # A module level function is used so the instance stays
+            # picklable.
+            self.on_attach = self.on_detach = _no_op
+            self.on_import = self.on_prune = _no_op
+            self.on_change_input = _no_op
 
     def on_attach(self, fgraph):
         if self.active:
@@ -485,6 +539,10 @@ class PreserveVariableAttributes(Feature):
     """
 
     def on_change_input(self, fgraph, node, i, r, new_r, reason=None):
+        # Fast path for the common case where there is nothing to preserve.
+        if (r.name is None and
+                'nan_guard_mode_check' not in r.tag.__dict__):
+            return
         if r.name is not None and new_r.name is None:
             new_r.name = r.name
         if getattr(r.tag, 'nan_guard_mode_check', False) and getattr(
@@ -502,8 +560,8 @@ class NoOutputFromInplace(Feature):
         if not hasattr(fgraph, 'destroyers'):
             return True
 
-        outputs_to_validate = list(fgraph.outputs)[self.first_idx:
-                                                   self.last_idx]
+        outputs_to_validate = islice(fgraph.outputs, self.first_idx,
+                                     self.last_idx)
 
         for out in outputs_to_validate:
 
@@ -513,9 +571,10 @@ class NoOutputFromInplace(Feature):
             # Validate that the node that produces the output does not produce
             # it by modifying something else inplace.
             node = out.owner
-            op = node.op
-            out_idx = node.outputs.index(out)
-            if hasattr(op, 'destroy_map') and out_idx in op.destroy_map:
+            destroy_map = getattr(node.op, 'destroy_map', None)
+            if not destroy_map:
+                continue
+            if node.outputs.index(out) in destroy_map:
                 raise theano.gof.InconsistencyError(
                     "A function graph Feature has requested (probably for ",
                     "efficiency reasons for scan) that outputs of the graph",
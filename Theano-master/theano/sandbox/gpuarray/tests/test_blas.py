@@ -19,16 +19,27 @@ from ..blas import (gpugemv_inplace, gpugemv_no_inplace,
                     gpuger_inplace, gpuger_no_inplace,
                     GpuGer, gpu_dot22, GpuGemm)
 
+# makeTester copies the inputs into shared variables, so the cases can
+# share a single random array per shape instead of drawing a new one each
+# time.
+_rand_pool = {}
+
+
+def _rand(*shape):
+    if shape not in _rand_pool:
+        _rand_pool[shape] = rand(*shape)
+    return _rand_pool[shape]
+
 
 GpuGemvTester = makeTester(
     'GpuGemvTester',
     op=gemv_inplace, gpu_op=gpugemv_inplace,
-    cases=dict(dot_vv=[rand(1), 1, rand(1, 2), rand(2), 0],
-               dot_vm=[rand(3), 1, rand(3, 2), rand(2), 0],
-               # test_02=[rand(0), 1, rand(0, 2), rand(2), 0],
-               # test_30=[rand(3), 1, rand(3, 0), rand(0), 0],
-               # test_00=[rand(0), 1, rand(0, 0), rand(0), 0],
-               test_stride=[rand(3)[::-1], 1, rand(3, 2)[::-1], rand(2)[::-1], 0],
+    cases=dict(dot_vv=[_rand(1), 1, _rand(1, 2), _rand(2), 0],
+               dot_vm=[_rand(3), 1, _rand(3, 2), _rand(2), 0],
+               # test_02=[_rand(0), 1, _rand(0, 2), _rand(2), 0],
+               # test_30=[_rand(3), 1, _rand(3, 0), _rand(0), 0],
+               # test_00=[_rand(0), 1, _rand(0, 0), _rand(0), 0],
+               test_stride=[_rand(3)[::-1], 1, _rand(3, 2)[::-1], _rand(2)[::-1], 0],
                )
     )
 
@@ -51,19 +62,19 @@ class TestGpuSgemv(TestCase, BaseGemv, utt.TestOptimizationMixin):
 GpuGemmTester = makeTester(
     'GpuGemmTester',
     op=gemm_inplace, gpu_op=gpugemm_inplace,
-    cases=dict(test1=[rand(3, 4), 1.0, rand(3, 5), rand(5, 4), 0.0],
-               test2=[rand(3, 4), 1.0, rand(3, 5), rand(5, 4), 1.0],
-               test3=[rand(3, 4), 1.0, rand(3, 5), rand(5, 4), -1.0],
-               test4=[rand(3, 4), 0.0, rand(3, 5), rand(5, 4), 0.0],
-               test5=[rand(3, 4), 0.0, rand(3, 5), rand(5, 4), 0.6],
-               test6=[rand(3, 4), 0.0, rand(3, 5), rand(5, 4), -1.0],
-               test7=[rand(3, 4), -1.0, rand(3, 5), rand(5, 4), 0.0],
-               test8=[rand(3, 4), -1.0, rand(3, 5), rand(5, 4), 1.1],
-               test9=[rand(3, 4), -1.0, rand(3, 5), rand(5, 4), -1.1],
-               # test10=[rand(0, 4), -1.0, rand(0, 5), rand(5, 4), 0.0],
-               # test11=[rand(3, 0), -1.0, rand(3, 5), rand(5, 0), 1.1],
-               # test12=[rand(3, 4), -1.0, rand(3, 0), rand(0, 4), -1.1],
-               # test13=[rand(0, 0), -1.0, rand(0, 0), rand(0, 0), -1.1],
+    cases=dict(test1=[_rand(3, 4), 1.0, _rand(3, 5), _rand(5, 4), 0.0],
+               test2=[_rand(3, 4), 1.0, _rand(3, 5), _rand(5, 4), 1.0],
+               test3=[_rand(3, 4), 1.0, _rand(3, 5), _rand(5, 4), -1.0],
+               test4=[_rand(3, 4), 0.0, _rand(3, 5), _rand(5, 4), 0.0],
+               test5=[_rand(3, 4), 0.0, _rand(3, 5), _rand(5, 4), 0.6],
+               test6=[_rand(3, 4), 0.0, _rand(3, 5), _rand(5, 4), -1.0],
+               test7=[_rand(3, 4), -1.0, _rand(3, 5), _rand(5, 4), 0.0],
+               test8=[_rand(3, 4), -1.0, _rand(3, 5), _rand(5, 4), 1.1],
+               test9=[_rand(3, 4), -1.0, _rand(3, 5), _rand(5, 4), -1.1],
+               # test10=[_rand(0, 4), -1.0, _rand(0, 5), _rand(5, 4), 0.0],
+               # test11=[_rand(3, 0), -1.0, _rand(3, 5), _rand(5, 0), 1.1],
+               # test12=[_rand(3, 4), -1.0, _rand(3, 0), _rand(0, 4), -1.1],
+               # test13=[_rand(0, 0), -1.0, _rand(0, 0), _rand(0, 0), -1.1],
                )
     )
 
@@ -108,15 +119,15 @@ GpuDot22Tester = makeTester(
     'GpuDot22Tester',
     op=_dot22, gpu_op=gpu_dot22,
     cases=dict(
-        test1=[rand(3, 4), rand(4, 5)],
-        test2=[rand(1, 4), rand(4, 5)],
-        test3=[rand(3, 1), rand(1, 5)],
-        test4=[rand(3, 4), rand(4, 1)],
-        # test5=[rand(0, 4), rand(4, 5)],
-        # test6=[rand(3, 0), rand(0, 5)],
-        # test7=[rand(3, 4), rand(4, 0)],
-        # test8=[rand(0, 4), rand(4, 0)],
-        # test9=[rand(0, 0), rand(0, 0)],
+        test1=[_rand(3, 4), _rand(4, 5)],
+        test2=[_rand(1, 4), _rand(4, 5)],
+        test3=[_rand(3, 1), _rand(1, 5)],
+        test4=[_rand(3, 4), _rand(4, 1)],
+        # test5=[_rand(0, 4), _rand(4, 5)],
+        # test6=[_rand(3, 0), _rand(0, 5)],
+        # test7=[_rand(3, 4), _rand(4, 0)],
+        # test8=[_rand(0, 4), _rand(4, 0)],
+        # test9=[_rand(0, 0), _rand(0, 0)],
     )
 )
 
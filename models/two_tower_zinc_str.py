@@ -1,18 +1,118 @@
-import copy
+import os
+import tempfile
+
+import numpy as np
 from keras import backend as K
-from keras.losses import binary_crossentropy, categorical_crossentropy, mse
+from keras.losses import binary_crossentropy
 from keras.models import Model
-from keras.layers import Input, Dense, Lambda, Concatenate, Reshape
-from keras.layers.core import Dense, Activation, Flatten, RepeatVector
-from keras.layers.wrappers import TimeDistributed
+from keras.optimizers import Adam
+from keras.utils import Sequence
+from keras.layers import Input, Dense, Lambda, Add
+from keras.layers.core import Activation, Flatten, RepeatVector
+from keras.layers import CuDNNGRU
 from keras.layers.recurrent import GRU
-from keras.layers.convolutional import Convolution1D
+from keras.layers import Conv1D
 import tensorflow as tf
-import pdb
 
 MAX_LEN_FUNCTIONAL = 200
 
 
+def int8_features(features, n):
+    """ Functional-group features as an (n, -1) int8 array, as the model
+        takes them. Values that int8 can't hold exactly are rejected rather
+        than silently truncated or wrapped. """
+    features = np.asarray(features).reshape(n, -1)
+    packed = features.astype(np.int8)
+    if not np.array_equal(packed, features):
+        raise ValueError("Functional-group features must be integers "
+                         "between -128 and 127")
+    return packed
+
+
+def _gru(units, name, use_cudnn):
+    # CuDNNGRU runs the whole recurrence in one fused kernel. Without a GPU,
+    # fall back to the equivalent GRU (reset_after, sigmoid gates), which can
+    # load the same weights.
+    if use_cudnn:
+        return CuDNNGRU(units, return_sequences=True, name=name)
+    return GRU(units, return_sequences=True, reset_after=True,
+               recurrent_activation='sigmoid', name=name)
+
+
+def _sampling(epsilon_std):
+    def sampling(args):
+        z_mean_, z_log_var_ = args
+        epsilon = K.random_normal(shape=K.shape(z_mean_), mean=0., stddev=epsilon_std)
+        # Clipping keeps exp() finite for extreme log-variances.
+        return z_mean_ + K.exp(K.clip(0.5 * z_log_var_, -10., 10.)) * epsilon
+    return sampling
+
+
+def _vae_loss(z_mean, z_log_var, max_length):
+    # The KL term is the same for both outputs, so it is built once. Each
+    # output gets its own reconstruction loss, chosen here rather than by
+    # checking the output shape every time the loss is built.
+    z_log_var = K.clip(z_log_var, -20., 20.)
+    kl_loss = - 0.5 * K.mean(1 + z_log_var - K.square(z_mean) - K.exp(z_log_var), axis=-1)
+
+    def smiles_loss(x, x_decoded_mean):
+        x = K.flatten(x)
+        x_decoded_mean = K.flatten(x_decoded_mean)
+        return max_length * binary_crossentropy(x, x_decoded_mean) + kl_loss
+
+    def functional_loss(x, x_decoded_mean):
+        # Sum of squared errors, i.e. max_length_functional * mse without the
+        # mean and rescale.
+        return K.sum(K.square(x - x_decoded_mean), axis=-1) + kl_loss
+
+    return {'decoded_mean': smiles_loss, 'decoded_mean_2': functional_loss}
+
+
+def _export_frozen(build_model, weights_file, export_dir, input_keys, output_keys):
+    # The model is built in a graph of its own, so the export holds none of
+    # the training graph (losses, sampling, optimizer and its slot variables),
+    # and its weights are frozen into constants.
+    graph = tf.Graph()
+    with tf.Session(graph=graph) as sess:
+        model = build_model()
+        model.load_weights(weights_file, by_name=True)
+        inputs = [t.name for t in model.inputs]
+        outputs = [t.name for t in model.outputs]
+        graph_def = tf.graph_util.convert_variables_to_constants(
+            sess, graph.as_graph_def(), [name.split(':')[0] for name in outputs])
+
+    frozen = tf.Graph()
+    with tf.Session(graph=frozen) as sess:
+        tf.import_graph_def(graph_def, name='')
+        tf.saved_model.simple_save(
+            sess, export_dir,
+            inputs=dict(zip(input_keys, map(frozen.get_tensor_by_name, inputs))),
+            outputs=dict(zip(output_keys, map(frozen.get_tensor_by_name, outputs))))
+
+
+class _TwoTowerSequence(Sequence):
+    """ Batches of ([indices, features], [one-hot SMILES, features]).
+
+        Only the integer indices are held in memory. The one-hot target is
+        built per batch, so fit_generator workers can prepare the next
+        batches while the current one trains. """
+
+    def __init__(self, indices, features, charset_length, batch_size):
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.features = int8_features(features, len(self.indices))
+        self.batch_size = batch_size
+        self._eye = np.eye(charset_length, dtype=np.float32)
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, idx):
+        batch = slice(idx * self.batch_size, (idx + 1) * self.batch_size)
+        x = self.indices[batch]
+        f = self.features[batch]
+        return [x, f], [self._eye[x], f.astype(np.float32)]
+
+
 class MoleculeVAE():
     autoencoder = None
 
@@ -23,128 +123,158 @@ class MoleculeVAE():
                latent_rep_size=292,
                weights_file=None):
         charset_length = len(charset)
+        self._dims = (charset_length, max_length, max_length_functional, latent_rep_size)
 
-        x = Input(shape=(max_length, charset_length))
-        f = Input(shape=(max_length_functional, 1))
+        x = Input(shape=(max_length,), dtype='int32')
+        f = Input(shape=(max_length_functional,), dtype='int8')
 
-        _, z = self._buildEncoder(x, f, latent_rep_size, max_length, max_length_functional)
+        # The encoder and encoderMV are views of the same layers, so the
+        # towers are built (and their weights loaded) only once.
+        vae_losses, z_mean, z_log_var, z = self._buildEncoder(
+            x, f, latent_rep_size, max_length, max_length_functional, charset_length)
         self.encoder = Model([x, f], z)
+        self.encoderMV = Model([x, f], [z_mean, z_log_var])
 
-        encoded_input = Input(shape=(latent_rep_size,))
-        o, fo = self._buildDecoder(
-            encoded_input,
+        # The decoder layers are created once and applied both to a new input
+        # and to the encoder output, so the decoder and the autoencoder share
+        # their weights instead of building the graph twice.
+        decode = self._buildDecoder(
             latent_rep_size,
             max_length,
             max_length_functional,
             charset_length
         )
+        encoded_input = Input(shape=(latent_rep_size,))
         self.decoder = Model(
             encoded_input,
-            [o, fo]
-        )
-
-        x1 = Input(shape=(max_length, charset_length))
-        f1 = Input(shape=(max_length_functional, 1))
-        vae_loss, z1 = self._buildEncoder(x1, f1, latent_rep_size, max_length, max_length_functional)
-        o1, fo1 = self._buildDecoder(
-            z1,
-            latent_rep_size,
-            max_length,
-            max_length_functional,
-            charset_length
+            list(decode(encoded_input))
         )
         self.autoencoder = Model(
-            [x1, f1],
-            [o1, fo1]
+            [x, f],
+            list(decode(z))
         )
 
-        x2 = Input(shape=(max_length, charset_length))
-        f2 = Input(shape=(max_length_functional, 1))
-        (z_m, z_l_v) = self._encoderMeanVar(x2, f2, latent_rep_size, max_length, max_length_functional)
-        self.encoderMV = Model(inputs=[x2, f2], outputs=[z_m, z_l_v])
-
         if weights_file:
+            # This also loads the encoders and the decoder, which share its layers.
             self.autoencoder.load_weights(weights_file)
-            self.encoder.load_weights(weights_file, by_name=True)
-            self.decoder.load_weights(weights_file, by_name=True)
-            self.encoderMV.load_weights(weights_file, by_name=True)
 
-        self.autoencoder.compile(optimizer='Adam',
-                                 loss={'decoded_mean': vae_loss, 'decoded_mean_2': vae_loss},
-                                 metrics=['accuracy'])
+        self.autoencoder.compile(optimizer=Adam(lr=1e-3),
+                                 loss=vae_losses,
+                                 metrics={'decoded_mean': 'accuracy'})
+
+        # Build the inference functions now rather than on the first predict()
+        # call. Each one is a single graph that takes any batch size.
+        for model in (self.encoder, self.encoderMV, self.decoder):
+            model._make_predict_function()
 
-    def _towers(self, x, f, max_length, max_length_func):
+    @staticmethod
+    def make_dataset(indices, features, charset_length, batch_size):
+        """ Training data for autoencoder.fit_generator from padded character
+            indices, shape (N, max_length), and functional-group features. """
+        return _TwoTowerSequence(indices, features, charset_length, batch_size)
+
+    def _towers(self, x, f, max_length, max_length_func, charset_length):
         # Tower 1
-        h = Convolution1D(9, 9, activation='relu', name='conv_1')(x)
-        h = Convolution1D(9, 9, activation='relu', name='conv_2')(h)
-        h = Convolution1D(10, 11, activation='relu', name='conv_3')(h)
+        # x holds the character indices. The one-hot encoding is built on the
+        # device, so only max_length integers per molecule are transferred.
+        h = Lambda(lambda t: K.one_hot(t, charset_length), output_shape=(max_length, charset_length), name='one_hot')(x)
+        h = Conv1D(9, 9, activation='relu', name='conv_1')(h)
+        h = Conv1D(9, 9, activation='relu', name='conv_2')(h)
+        h = Conv1D(10, 11, activation='relu', name='conv_3')(h)
         h = Flatten(name='flatten_1')(h)
 
         # Tower 2
-        hf = Flatten(name='tower_2_flatten_enc')(f)
+        # f holds small integers and is fed as int8, a quarter of the size of
+        # float32. Cast it once on the device.
+        hf = Lambda(lambda t: K.cast(t, K.floatx()), name='tower_2_cast')(f)
         hf = Dense(256, activation='relu', name='tower_2_dense_1')(hf)
 
         # Merge
-        h = Concatenate()([h, hf])
-        return Dense(435, activation='relu', name='dense_1')(h)
+        # Dense over [h, hf] is h @ W_h + hf @ W_hf + b, so each tower gets its
+        # own half of the weights and no concatenated copy is allocated.
+        h = Add()([
+            Dense(435, name='dense_1_h')(h),
+            Dense(435, use_bias=False, name='dense_1_hf')(hf),
+        ])
+        return Activation('relu', name='dense_1')(h)
 
-    def _encoderMeanVar(self, x, f, latent_rep_size, max_length, max_length_func, epsilon_std=0.01):
-        h = self._towers(x, f, max_length, max_length_func)
+    def _buildEncoder(self, x, f, latent_rep_size, max_length, max_length_func, charset_length, epsilon_std=0.01):
+        h = self._towers(x, f, max_length, max_length_func, charset_length)
 
         z_mean = Dense(latent_rep_size, name='z_mean', activation='linear')(h)
         z_log_var = Dense(latent_rep_size, name='z_log_var', activation='linear')(h)
 
-        return (z_mean, z_log_var)
-
-    def _buildEncoder(self, x, f, latent_rep_size, max_length, max_length_func, epsilon_std=0.01):
-        h = self._towers(x, f, max_length, max_length_func)
+        vae_losses = _vae_loss(z_mean, z_log_var, max_length)
+        z = Lambda(_sampling(epsilon_std), output_shape=(latent_rep_size,), name='lambda')([z_mean, z_log_var])
+        return (vae_losses, z_mean, z_log_var, z)
 
-        def sampling(args):
-            z_mean_, z_log_var_ = args
-            batch_size = K.shape(z_mean_)[0]
-            epsilon = K.random_normal(shape=(batch_size, latent_rep_size), mean=0., stddev=epsilon_std)
-            return z_mean_ + K.exp(z_log_var_ / 2) * epsilon
+    def _buildDecoder(self, latent_rep_size, max_length, max_length_functional, charset_length, use_cudnn=None):
+        latent_input = Dense(latent_rep_size, name='latent_input', activation='relu')
+        if use_cudnn is None:
+            use_cudnn = bool(tf.config.experimental.list_physical_devices('GPU'))
 
-        z_mean = Dense(latent_rep_size, name='z_mean', activation='linear')(h)
-        z_log_var = Dense(latent_rep_size, name='z_log_var', activation='linear')(h)
-
-        def vae_loss(x, x_decoded_mean):
+        # Tower 1
+        tower_1 = [
+            RepeatVector(max_length, name='repeat_vector'),
+            _gru(501, name='gru_1', use_cudnn=use_cudnn),
+            _gru(501, name='gru_2', use_cudnn=use_cudnn),
+            _gru(501, name='gru_3', use_cudnn=use_cudnn),
+            Dense(charset_length, activation='softmax', name='decoded_mean'),
+        ]
 
-            if K.int_shape(x_decoded_mean)[1] == max_length:
-                x = K.flatten(x)
-                x_decoded_mean = K.flatten(x_decoded_mean)
-                xent_loss = max_length * binary_crossentropy(x, x_decoded_mean)
-            elif K.int_shape(x_decoded_mean)[1] == max_length_func:
-                t = tf.reshape(x, (-1, max_length_func))
-                p = tf.reshape(x_decoded_mean, (-1, max_length_func))
-                xent_loss = max_length_func * mse(t, p)
-            else:
-                raise ValueError('UNRECOGNIZED SHAPE')
+        # Tower 2
+        # Dense(128, name='dense_tower_1', activation = 'relu'),
+        tower_2 = [
+            Dense(max_length_functional, name='decoded_mean_2', activation='sigmoid'),
+        ]
 
-            kl_loss = - 0.5 * K.mean(1 + z_log_var - K.square(z_mean) - K.exp(z_log_var), axis=-1)
-            return xent_loss + kl_loss
+        def decode(z):
+            l = latent_input(z)
+            h = l
+            for layer in tower_1:
+                h = layer(h)
+            hf = l
+            for layer in tower_2:
+                hf = layer(hf)
+            return h, hf
 
-        return (vae_loss, Lambda(sampling, output_shape=(latent_rep_size,), name='lambda')([z_mean, z_log_var]))
+        return decode
 
-    def _buildDecoder(self, z, latent_rep_size, max_length, max_length_functional, charset_length):
-        l = Dense(latent_rep_size, name='latent_input', activation='relu')(z)
+    def save(self, filename):
+        self.autoencoder.save_weights(filename)
 
-        # Tower 1
-        h = RepeatVector(max_length, name='repeat_vector')(l)
-        h = GRU(501, return_sequences=True, name='gru_1')(h)
-        h = GRU(501, return_sequences=True, name='gru_2')(h)
-        h = GRU(501, return_sequences=True, name='gru_3')(h)
-        h = TimeDistributed(Dense(charset_length, activation='softmax'), name='decoded_mean')(h)
+    def export(self, encoder_dir, decoder_dir):
+        """ Write the mean/log-variance encoder and the decoder as separate
+            SavedModels for inference. Each holds only its own frozen
+            subgraph, and uses GRU rather than CuDNNGRU so that it also runs
+            on a CPU. """
+        charset_length, max_length, max_length_functional, latent_rep_size = self._dims
 
-        # Tower 2
-        # hf = Dense(128, name='dense_tower_1', activation = 'relu')(l)
-        hf = Dense(200, name='dense_tower_2', activation='sigmoid')(l)
-        hf = Reshape((200, 1), name='decoded_mean_2')(hf)
+        def encoder():
+            x = Input(shape=(max_length,), dtype='int32')
+            f = Input(shape=(max_length_functional,), dtype='int8')
+            _, z_mean, z_log_var, _ = self._buildEncoder(
+                x, f, latent_rep_size, max_length, max_length_functional, charset_length)
+            return Model([x, f], [z_mean, z_log_var])
 
-        return h, hf
+        def decoder():
+            z = Input(shape=(latent_rep_size,))
+            decode = self._buildDecoder(
+                latent_rep_size, max_length, max_length_functional, charset_length, use_cudnn=False)
+            return Model(z, list(decode(z)))
 
-    def save(self, filename):
-        self.autoencoder.save_weights(filename)
+        # The weights go through a file rather than set_weights, because
+        # load_weights converts CuDNNGRU weights for GRU.
+        fd, weights_file = tempfile.mkstemp(suffix='.h5')
+        os.close(fd)
+        try:
+            self.save(weights_file)
+            _export_frozen(encoder, weights_file, encoder_dir,
+                           ['smiles', 'features'], ['z_mean', 'z_log_var'])
+            _export_frozen(decoder, weights_file, decoder_dir,
+                           ['z'], ['decoded_mean', 'decoded_mean_2'])
+        finally:
+            os.remove(weights_file)
 
     def load(self, charset, weights_file, latent_rep_size=292, max_length=120):
         self.create(charset, weights_file=weights_file, latent_rep_size=latent_rep_size)
\ No newline at end of file
@@ -261,12 +261,12 @@ class TwoTowerCharacterModel(object):
     def encode(self, smiles, features):
         """ Encode a list of smiles strings into the latent space """
         indices = [np.array([self._char_index[c] for c in entry], dtype=int) for entry in smiles]
-        one_hot = np.zeros((len(indices), self.MAX_LEN, len(self.charlist)), dtype=np.float32)
+        # The model one-hot encodes the indices itself; pad with the last character.
+        padded = np.full((len(indices), self.MAX_LEN), len(self.charlist) - 1, dtype=np.int32)
         for i in range(len(indices)):
-            num_productions = len(indices[i])
-            one_hot[i][np.arange(num_productions),indices[i]] = 1.
-            one_hot[i][np.arange(num_productions, self.MAX_LEN),-1] = 1.
-        return self.vae.encoderMV.predict([one_hot, features])[0]
+            padded[i][:len(indices[i])] = indices[i]
+        features = self._model.int8_features(features, len(smiles))
+        return self.vae.encoderMV.predict([padded, features])[0]
 
     def decode(self, z):
         """ Sample from the character decoder """